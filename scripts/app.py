@@ -1,38 +1,126 @@
 from flask import Flask, request, jsonify
-from model import load_model, get_important_features_from_text
-from preprocessing import preprocess_text
+from model import load_model, prepare_for_serving, get_important_features_from_text, explain_text, EXPLAINERS
+from preprocessing import preprocess_text, preprocess_text_with_report
 import uuid
-from db import init_db, get_db_connection
+from db import init_db, get_db_connection, load_all_predictions, run_maintenance, MAINTENANCE_INTERVAL_SECONDS
+from similarity import load_index, sync_index, prune_index, vectorizer_fingerprint
 import datetime
 from flask_cors import CORS
 from langdetect import detect, DetectorFactory
-from prometheus_client import Counter, Gauge, Summary, generate_latest, REGISTRY
+from metrics import (prediction_count, correct_predictions, incorrect_predictions, prediction_confidence,
+                     generate_metrics)
 from flask import Response
 import os
-from lime.lime_text import LimeTextExplainer
+import threading
+import time
 import numpy as np
 
 app = Flask(__name__)
 CORS(app)
 # CORS(app, resources={r"/api/*": {"origins": "http://localhost:5000"}})  # Allow only specific origins
 
-# Load the pre-trained model
-model_path = os.path.join(os.getcwd(), 'random_forest_model.pkl')
-model = load_model(model_path)
+# Load the pre-trained model (MODEL_PATH can point to a streaming model from train.py --streaming)
+model_path = os.environ.get('MODEL_PATH', os.path.join(os.getcwd(), 'random_forest_model.pkl'))
+model = prepare_for_serving(load_model(model_path))
+
+# The tree explainer reads the decision paths of a tree ensemble, so it is unavailable for the streaming model
+AVAILABLE_EXPLAINERS = [
+    name for name in EXPLAINERS if name != 'tree' or hasattr(model.named_steps['classifier'], 'estimators_')
+]
 print("Model loaded successfully!")
 
 # Initialize the database
 init_db()
 
+
+def maintenance_loop():
+    """Periodically archive old predictions, compact the database and drop archived issues from the index."""
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            run_maintenance()
+            # Also drops issues another process archived
+            conn = get_db_connection()
+            try:
+                prune_index(similarity_index, conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Database maintenance failed: {e}")
+
+
+def start_maintenance_thread():
+    """
+    Run maintenance_loop in a background thread of the serving process. Not started at import,
+    so the production server's parent process stays single-threaded and is safe to fork from.
+    """
+    threading.Thread(target=maintenance_loop, daemon=True).start()
+
+# Save the similar-issue index after this many new predictions
+INDEX_SAVE_EVERY = 50
+
+# Most similar issues returned by one /api/similar request
+MAX_SIMILAR_K = 50
+
+
+def vectorize_issue(title, body):
+    """Map an issue's title and body to the TF-IDF vector used by the similarity index."""
+    text = str(title or '').strip() + ' ' + str(body or '').strip()
+    return model.named_steps['tfidf'].transform([' '.join(preprocess_text(text))])
+
+
+def vectorize_preprocessed(preprocessed_text):
+    """Map a stored preprocessed text to the TF-IDF vector used by the similarity index."""
+    return model.named_steps['tfidf'].transform([preprocessed_text])
+
+
+# Load the similar-issue index and add predictions stored while it was offline (in the parent
+# process under the production server, so rows from before preprocessed text was stored are
+# preprocessed once here and never on the request path)
+similarity_index = load_index(
+    model.named_steps['tfidf'].transform(['']).shape[1],
+    fingerprint=vectorizer_fingerprint(model.named_steps['tfidf'])
+)
+index_conn = get_db_connection()
+added = sync_index(similarity_index, index_conn, vectorize_preprocessed, vectorize_raw=vectorize_issue)
+if prune_index(similarity_index, index_conn) or added:
+    similarity_index.save()
+index_conn.close()
+print(f"Similarity index loaded with {len(similarity_index)} issues.")
+
 # Ensure consistent results for from langdetect library
 DetectorFactory.seed = 0
 
-# Metrics
-prediction_count = Counter('predictions_total', 'Number of predictions made', ['category'])
-correct_predictions = Counter('correct_predictions_total', 'Number of correct predictions', ['category'])
-incorrect_predictions = Counter('incorrect_predictions_total', 'Number of incorrect predictions', ['category'])
-prediction_confidence = Summary('prediction_confidence', 'Prediction confidence values')
-model_accuracy = Gauge('model_accuracy', 'Model accuracy')
+
+# Readiness, reported by /readyz once warm-up has succeeded
+ready = False
+warm_up_error = None
+
+
+def warm_up():
+    """
+    Run one prediction end to end so NLTK's lazily loaded corpora, the model and the
+    explainers are fully initialised. Under the production server this runs once in the
+    parent process, so forked workers share the loaded data copy-on-write.
+    """
+    global ready, warm_up_error
+    try:
+        tokens = preprocess_text("The application crashes when I click the submit button")
+        preprocessed_text = ' '.join(tokens)
+        model.predict_proba([preprocessed_text])
+        if 'tree' in AVAILABLE_EXPLAINERS:
+            explain_text(model, preprocessed_text, method='tree')
+        detect("The application crashes when I click the submit button")
+        ready = True
+        warm_up_error = None
+        print("Warm-up complete.")
+    except Exception as e:
+        ready = False
+        warm_up_error = str(e)
+        print(f"Warm-up failed: {e}")
+
+
+warm_up()
 
 
 @app.route('/')
@@ -40,6 +128,20 @@ def home():
     return "Welcome to the Issue Prediction API! Use the /predict endpoint to make predictions."
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # The process is up and serving requests
+    return jsonify({"status": "ok", "pid": os.getpid()}), 200
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # The model and NLTK data are loaded and a warm-up prediction succeeded
+    if not ready:
+        return jsonify({"status": "warming up", "error": warm_up_error, "pid": os.getpid()}), 503
+    return jsonify({"status": "ready", "pid": os.getpid()}), 200
+
+
 @app.route('/api/predict', methods=['POST'])
 def predict_issue():
     try:
@@ -49,6 +151,11 @@ def predict_issue():
         title = data.get('title', '')
         body = data.get('body', '')
 
+        # Explanation engine: 'lime' (default) or 'tree'
+        explainer = data.get('explainer', 'lime')
+        if explainer not in AVAILABLE_EXPLAINERS:
+            return jsonify({"error": f"explainer must be one of: {', '.join(AVAILABLE_EXPLAINERS)}"}), 400
+
         # Ensure both title and body are strings and handle missing values
         text = str(title).strip() + ' ' + str(body).strip()
         print(f"input text: {text}")
@@ -61,8 +168,8 @@ def predict_issue():
                 "detected_language": language
             }), 400
 
-        # Preprocess the input text (use your preprocess_text function)
-        preprocessed_data = preprocess_text(text)
+        # Preprocess the input text within the input budget (long logs and stack traces are cut)
+        preprocessed_data, truncation = preprocess_text_with_report(text)
         # Debugging tokens
         tokens = preprocessed_data
         print(f"Tokens during inference: {tokens}")
@@ -98,24 +205,22 @@ def predict_issue():
         cursor = conn.cursor()
         # noinspection SqlDialectInspection,SqlNoDataSourceInspection
         cursor.execute('''
-                    INSERT INTO predictions (id, title, body, predicted_label, confidence) 
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (issue_id, title, body, predicted_label, confidence))
+                    INSERT INTO predictions (id, title, body, predicted_label, confidence, preprocessed_text) 
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (issue_id, title, body, predicted_label, confidence, preprocessed_text))
         conn.commit()
         conn.close()
 
-        # LIME Explanation
-        class_names = model.named_steps['classifier'].classes_.tolist()
-        explainer = LimeTextExplainer(class_names=class_names)
-        lime_exp = explainer.explain_instance(
-            preprocessed_text,
-            model.predict_proba,
-            num_features=10
-        )
-        lime_explanation = lime_exp.as_list()  # List of (word, weight) tuples
+        # Make the new issue available to /api/similar
+        similarity_index.add(issue_id, model.named_steps['tfidf'].transform([preprocessed_text]))
+        if similarity_index.unsaved >= INDEX_SAVE_EVERY:
+            similarity_index.save()
+
+        # Explanation as a list of (word, weight) tuples, kept under the key the client renders
+        lime_explanation = explain_text(model, preprocessed_text, method=explainer, num_features=10)
 
         # Return the prediction and issue ID
-        return jsonify({"id": issue_id, "predicted_label": predicted_label, "confidence": confidence, "important_features": important_features, "lime_explanation": lime_explanation}), 200
+        return jsonify({"id": issue_id, "predicted_label": predicted_label, "confidence": confidence, "important_features": important_features, "lime_explanation": lime_explanation, "explainer": explainer, "input_truncation": truncation}), 200
 
     except Exception as e:
         print(f"Error: {e}")
@@ -155,17 +260,7 @@ def correct_prediction():
             # Update metrics
             incorrect_predictions.labels(corrected_label).inc()
 
-        # calculate the accuracy metric based on the counters
-        total_correct = sum(
-            sample.value for metric in correct_predictions.collect() for sample in metric.samples
-        )
-        total_incorrect = sum(
-            sample.value for metric in incorrect_predictions.collect() for sample in metric.samples
-        )
-        total_predictions = total_correct + total_incorrect
-        if total_predictions > 0:
-            accuracy = total_correct / total_predictions
-            model_accuracy.set(accuracy)
+        # model_accuracy is derived from these counters when /metrics is scraped
 
         # Get the current timestamp
         timestamp = datetime.datetime.now()
@@ -197,20 +292,15 @@ def correct_prediction():
 def view_predictions():
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
 
-        # Retrieve all rows from the predictions table
-        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
-        cursor.execute('SELECT * FROM predictions')
-        rows = cursor.fetchall()
-
-        # Get the column names
-        column_names = [description[0] for description in cursor.description]
+        # Retrieve all rows from the predictions table, plus the archive if requested
+        include_archive = request.args.get('include_archive', 'false').lower() == 'true'
+        rows = load_all_predictions(conn, include_archive=include_archive)
 
-        # Convert rows into a list of dictionaries and decode any bytes
+        # Decode any bytes
         result = [
             {key: (value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value)
-             for key, value in zip(column_names, row)}
+             for key, value in row.items()}
             for row in rows
         ]
 
@@ -223,9 +313,67 @@ def view_predictions():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/similar', methods=['POST'])
+def similar_issues():
+    try:
+        data = request.get_json()
+        issue_id = data.get('id')
+        k = data.get('k', 5)
+        if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_SIMILAR_K:
+            return jsonify({"error": f"k must be an integer between 1 and {MAX_SIMILAR_K}"}), 400
+        mode = data.get('mode', 'lsh')
+        if mode not in ('lsh', 'exact'):
+            return jsonify({"error": "mode must be 'lsh' or 'exact'"}), 400
+
+        # Pick up predictions stored by other worker processes
+        conn = get_db_connection()
+        sync_index(similarity_index, conn, vectorize_preprocessed)
+
+        # Look up a stored issue by ID, or vectorize the given title and body
+        if issue_id:
+            vector = similarity_index.vector_for(issue_id)
+            if vector is None:
+                conn.close()
+                return jsonify({'error': 'Prediction ID not found'}), 404
+        else:
+            vector = vectorize_issue(data.get('title', ''), data.get('body', ''))
+
+        # Fetch the stored details of the neighbours. Neighbours archived since they were indexed
+        # are dropped from the index and the lookup is repeated, so k live issues are returned
+        cursor = conn.cursor()
+        while True:
+            neighbours = similarity_index.query(vector, k=k, exact=(mode == 'exact'), exclude=issue_id)
+            results, archived = [], []
+            for neighbour_id, similarity in neighbours:
+                # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+                cursor.execute(
+                    'SELECT title, predicted_label, corrected_label FROM predictions WHERE id = ?',
+                    (neighbour_id,)
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    archived.append(neighbour_id)
+                    continue
+                results.append({
+                    "id": neighbour_id,
+                    "title": row[0],
+                    "predicted_label": row[1],
+                    "corrected_label": row[2],
+                    "similarity": similarity
+                })
+            if not archived or not similarity_index.remove(archived):
+                break
+        conn.close()
+
+        return jsonify({"mode": mode, "similar_issues": results}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return Response(generate_latest(REGISTRY), content_type='text/plain')
+    return Response(generate_metrics(), content_type='text/plain')
 
 
 @app.route('/api/explain', methods=['POST'])
@@ -237,6 +385,11 @@ def explain_prediction():
         body = data.get('body', '')
         full_text = str(title).strip() + ' ' + str(body).strip()
 
+        # Explanation engine: 'lime' (default) or 'tree'
+        explainer = data.get('explainer', 'lime')
+        if explainer not in AVAILABLE_EXPLAINERS:
+            return jsonify({"error": f"explainer must be one of: {', '.join(AVAILABLE_EXPLAINERS)}"}), 400
+
         # Check language
         language = detect(full_text)
         if language != 'en':
@@ -246,27 +399,18 @@ def explain_prediction():
             }), 400
 
         # Preprocess
-        preprocessed_tokens = preprocess_text(full_text)
+        preprocessed_tokens, truncation = preprocess_text_with_report(full_text)
         preprocessed_text = ' '.join(preprocessed_tokens)
 
-        # LIME explainer for text
-        class_names = model.named_steps['classifier'].classes_.tolist()
-        explainer = LimeTextExplainer(class_names=class_names)
-
         # Explain instance
-        explanation = explainer.explain_instance(
-            preprocessed_text,
-            model.predict_proba,
-            num_features=10
-        )
-
-        # Get explanation as list
-        explanation_data = explanation.as_list()
+        explanation_data = explain_text(model, preprocessed_text, method=explainer, num_features=10)
 
         return jsonify({
             "input_text": full_text,
             "predicted_label": model.predict([preprocessed_text])[0],
-            "explanation": explanation_data  # List of tuples (word, weight)
+            "explainer": explainer,
+            "explanation": explanation_data,  # List of tuples (word, weight)
+            "input_truncation": truncation
         }), 200
 
     except Exception as e:
@@ -274,4 +418,5 @@ def explain_prediction():
 
 
 if __name__ == "__main__":
+    start_maintenance_thread()
     app.run(debug=True)
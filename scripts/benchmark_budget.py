@@ -0,0 +1,71 @@
+import os
+import time
+import pandas as pd
+from model import load_model
+from preprocessing import preprocess_text_with_report
+
+
+def predict_labels(model, texts, **budget):
+    """Preprocess texts with the given budget settings and predict their labels."""
+    preprocessed = []
+    truncated = 0
+    for text in texts:
+        tokens, report = preprocess_text_with_report(text, **budget)
+        preprocessed.append(' '.join(tokens))
+        truncated += report["truncated"]
+    return model.predict(preprocessed), truncated
+
+
+def benchmark_budget(model, df):
+    """
+    Compare predictions with and without the input budget.
+
+    :param model: Fitted pipeline.
+    :param df: Predictions table with 'title', 'body' and 'corrected_label' columns.
+    :return: Dictionary of accuracies, agreement and the number of truncated texts.
+    """
+    texts = (df['title'].fillna('') + ' ' + df['body'].fillna('')).tolist()
+    labels = df['corrected_label'].fillna(df['predicted_label']).tolist()
+
+    bounded, truncated = predict_labels(model, texts)
+    unbounded, _ = predict_labels(model, texts, max_chars=None, max_tokens=None, max_repeated_lines=0)
+
+    return {
+        "texts": len(texts),
+        "truncated": truncated,
+        "accuracy_with_budget": sum(p == y for p, y in zip(bounded, labels)) / len(labels),
+        "accuracy_without_budget": sum(p == y for p, y in zip(unbounded, labels)) / len(labels),
+        "agreement": sum(a == b for a, b in zip(bounded, unbounded)) / len(labels),
+    }
+
+
+def time_long_input(text, repeats=3, **budget):
+    """Return the mean seconds needed to preprocess a text."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        preprocess_text_with_report(text, **budget)
+    return (time.perf_counter() - start) / repeats
+
+
+# Entry point for standalone usage
+if __name__ == '__main__':
+    model = load_model(os.path.join(os.getcwd(), 'random_forest_model.pkl'))
+    dataset = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets', 'predictions.csv')
+    df = pd.read_csv(dataset, encoding='ISO-8859-1')
+
+    results = benchmark_budget(model, df)
+    print(f"Texts: {results['texts']}, truncated by the budget: {results['truncated']}")
+    print(f"Accuracy with budget:    {results['accuracy_with_budget']:.4f}")
+    print(f"Accuracy without budget: {results['accuracy_without_budget']:.4f}")
+    print(f"Prediction agreement:    {results['agreement']:.4f}")
+
+    # A typical issue with a pasted stack trace and a long log, about 300 KB
+    long_text = (
+        "App crashes on login. Steps: enter password and click login.\n"
+        + "java.lang.NullPointerException\n"
+        + "".join(f"\tat com.example.Login.step{i}(Login.java:{i})\n" for i in range(2000))
+        + "".join(f"2024-01-01 10:00:{i % 60:02d} INFO request {i} handled in {i % 97} ms\n" for i in range(4000))
+    )
+    print(f"Long input ({len(long_text) // 1024} KB): "
+          f"{time_long_input(long_text) * 1000:.0f} ms with budget, "
+          f"{time_long_input(long_text, repeats=1, max_chars=None, max_tokens=None, max_repeated_lines=0) * 1000:.0f} ms without")
@@ -0,0 +1,81 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+from model import load_model, get_lime_explanation, get_tree_explanation
+from preprocessing import preprocess_text
+
+
+def rank_agreement(lime_explanation, tree_explanation):
+    """
+    Compare two explanations of the same prediction.
+
+    :param lime_explanation: List of (word, weight) tuples from LIME.
+    :param tree_explanation: List of (word, weight) tuples from the tree explainer.
+    :return: Tuple of (top-k word overlap, Spearman correlation of the shared words' weights).
+    """
+    lime_weights = {str(word): weight for word, weight in lime_explanation}
+    tree_weights = {str(word): weight for word, weight in tree_explanation}
+    shared = [word for word in lime_weights if word in tree_weights]
+    k = max(len(lime_weights), len(tree_weights), 1)
+    overlap = len(shared) / k
+    if len(shared) < 2:
+        return overlap, np.nan
+    correlation = spearmanr([lime_weights[w] for w in shared], [tree_weights[w] for w in shared]).statistic
+    return overlap, correlation
+
+
+def benchmark_explainers(model, texts, num_features=10):
+    """
+    Time LIME and the tree explainer on the same texts and measure how well they agree.
+
+    Both explainers explain the predicted class of each text.
+
+    :param model: Fitted pipeline with 'tfidf' and 'classifier' steps.
+    :param texts: Preprocessed texts to explain.
+    :param num_features: Number of words per explanation.
+    :return: DataFrame with one row per text.
+    """
+    rows = []
+    for text in texts:
+        label = int(np.argmax(model.predict_proba([text])[0]))
+
+        start = time.perf_counter()
+        lime_explanation = get_lime_explanation(model, text, num_features=num_features, label=label)
+        lime_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree_explanation = get_tree_explanation(model, text, num_features=num_features, label=label)
+        tree_seconds = time.perf_counter() - start
+
+        overlap, correlation = rank_agreement(lime_explanation, tree_explanation)
+        rows.append({
+            "lime_seconds": lime_seconds,
+            "tree_seconds": tree_seconds,
+            "top_k_overlap": overlap,
+            "spearman": correlation
+        })
+    return pd.DataFrame(rows)
+
+
+# Entry point for standalone usage
+if __name__ == '__main__':
+    model = load_model(os.path.join(os.getcwd(), 'random_forest_model.pkl'))
+    dataset = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets', 'predictions.csv')
+    df = pd.read_csv(dataset, encoding='ISO-8859-1').sample(n=50, random_state=42)
+
+    texts = [
+        ' '.join(preprocess_text(str(title) + ' ' + str(body)))
+        for title, body in zip(df['title'].fillna(''), df['body'].fillna(''))
+    ]
+    results = benchmark_explainers(model, texts)
+
+    print(f"Texts explained: {len(results)}")
+    print(f"LIME latency:  mean {results['lime_seconds'].mean() * 1000:.1f} ms, "
+          f"p95 {results['lime_seconds'].quantile(0.95) * 1000:.1f} ms")
+    print(f"Tree latency:  mean {results['tree_seconds'].mean() * 1000:.1f} ms, "
+          f"p95 {results['tree_seconds'].quantile(0.95) * 1000:.1f} ms")
+    print(f"Speed-up: {results['lime_seconds'].mean() / results['tree_seconds'].mean():.1f}x")
+    print(f"Top-10 word overlap: {results['top_k_overlap'].mean():.2f}")
+    print(f"Spearman correlation of shared words: {results['spearman'].mean():.2f}")
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# Importing app initialises and migrates the database, and test_app imports it at collection
+# time; point it at a scratch database (and similarity index) so the committed predictions.db
+# files are left untouched
+os.environ.setdefault('PREDICTIONS_DB', os.path.join(tempfile.mkdtemp(), 'predictions.db'))
@@ -1,7 +1,46 @@
+import csv
+import datetime
+import glob
+import gzip
+import json
+import os
 import sqlite3
 
-# Define the database name
-DB_NAME = 'predictions.db'
+# Define the database name (override with PREDICTIONS_DB, e.g. to run the tests against a scratch copy)
+DB_NAME = os.environ.get('PREDICTIONS_DB', 'predictions.db')
+
+# Storage lifecycle settings (override with environment variables)
+RETENTION_DAYS = int(os.environ.get('PREDICTIONS_RETENTION_DAYS', 180))  # Age after which rows are archived
+ARCHIVE_DIR = os.environ.get('PREDICTIONS_ARCHIVE_DIR', 'archive')  # Per-month gzipped NDJSON files
+INCREMENTAL_VACUUM_PAGES = int(os.environ.get('PREDICTIONS_VACUUM_PAGES', 1000))  # Pages freed per compaction
+MAINTENANCE_INTERVAL_SECONDS = int(os.environ.get('PREDICTIONS_MAINTENANCE_INTERVAL', 3600))
+
+PREDICTION_COLUMNS = [
+    "id", "title", "body", "predicted_label", "confidence", "corrected_label", "is_correct", "timestamp"
+]
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+# noinspection SqlDialectInspection,SqlNoDataSourceInspection
+MIGRATIONS = {
+    # Index for archiving by age
+    1: [
+        'CREATE INDEX IF NOT EXISTS idx_predictions_timestamp ON predictions (timestamp)',
+    ],
+    # Let the file shrink in small steps instead of growing forever (VACUUM applies the new mode)
+    2: [
+        'PRAGMA auto_vacuum = INCREMENTAL',
+        'VACUUM',
+    ],
+    # Keep the preprocessed text, so the similarity index can vectorize rows without rerunning NLTK
+    3: [
+        'ALTER TABLE predictions ADD COLUMN preprocessed_text TEXT',
+    ],
+    # No query filters on corrected_label (retraining reads the whole table), so the index
+    # created by earlier versions of migration 1 only slowed down every correction
+    4: [
+        'DROP INDEX IF EXISTS idx_predictions_corrected_label',
+    ],
+}
 
 
 def init_db():
@@ -26,11 +65,163 @@ def init_db():
 
         # Commit changes
         conn.commit()
+
+        # Bring the schema up to date
+        migrate_db(conn)
         print("Database initialized successfully.")
 
 
+def migrate_db(conn):
+    """
+    Apply the schema migrations the database has not seen yet.
+
+    :param conn: Open database connection.
+    :return: Schema version after migrating.
+    """
+    cursor = conn.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    for target in sorted(MIGRATIONS):
+        if target <= version:
+            continue
+        for statement in MIGRATIONS[target]:
+            cursor.execute(statement)
+        cursor.execute(f'PRAGMA user_version = {int(target)}')
+        conn.commit()
+        print(f"Database migrated to schema version {target}.")
+        version = target
+    return version
+
+
 def get_db_connection():
     """Create and return a new database connection."""
     conn = sqlite3.connect(DB_NAME)
     conn.row_factory = sqlite3.Row  # Allows fetching rows as dictionaries
     return conn
+
+
+def archive_old_predictions(conn, retention_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR):
+    """
+    Move predictions older than the retention period into per-month gzipped NDJSON files.
+
+    Rows are appended to ``<archive_dir>/predictions-YYYY-MM.ndjson.gz`` (one gzip member per
+    run) before they are deleted from the live table.
+
+    :param conn: Open database connection.
+    :param retention_days: Rows whose timestamp is older than this many days are archived.
+    :param archive_dir: Directory holding the archive files.
+    :return: Number of archived rows.
+    """
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+    cursor = conn.cursor()
+    # Hold the write lock from reading to deleting, so a row corrected (and re-timestamped) in
+    # between is neither deleted nor archived in its old state
+    conn.commit()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        cursor.execute(f'SELECT {", ".join(PREDICTION_COLUMNS)} FROM predictions WHERE timestamp < ?', (cutoff,))
+        rows = cursor.fetchall()
+
+        # Group rows by the month of their timestamp
+        months = {}
+        for row in rows:
+            record = dict(zip(PREDICTION_COLUMNS, row))
+            months.setdefault(str(record["timestamp"])[:7], []).append(record)
+
+        if months:
+            os.makedirs(archive_dir, exist_ok=True)
+        for month, records in months.items():
+            path = os.path.join(archive_dir, f'predictions-{month}.ndjson.gz')
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+        # Only delete once every row is safely on disk
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        cursor.executemany('DELETE FROM predictions WHERE id = ?', [(row[0],) for row in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def compact_db(conn, max_pages=INCREMENTAL_VACUUM_PAGES):
+    """
+    Return up to max_pages free pages to the file system with an incremental vacuum.
+
+    :param conn: Open database connection.
+    :param max_pages: Maximum number of pages to free in one step, so writers are not blocked for long.
+    :return: Number of free pages left.
+    """
+    # executescript steps the pragma to completion; execute() would free a single page
+    conn.executescript(f'PRAGMA incremental_vacuum({int(max_pages)});')
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def run_maintenance():
+    """Archive old predictions and compact the live database."""
+    conn = get_db_connection()
+    try:
+        archived = archive_old_predictions(conn)
+        free_pages = compact_db(conn)
+        print(f"Database maintenance: archived {archived} rows, {free_pages} free pages left.")
+        return archived
+    finally:
+        conn.close()
+
+
+def read_archived_predictions(archive_dir=ARCHIVE_DIR):
+    """Read every archived prediction as a list of dictionaries, oldest month first."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(archive_dir, 'predictions-*.ndjson.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def load_all_predictions(conn, include_archive=True, archive_dir=ARCHIVE_DIR):
+    """
+    Read live and (optionally) archived predictions.
+
+    :param conn: Open database connection.
+    :param include_archive: Whether to include rows moved to the archive.
+    :param archive_dir: Directory holding the archive files.
+    :return: List of dictionaries keyed by column name. Live rows win over archived copies of the same ID.
+    """
+    records = {}
+    if include_archive:
+        for record in read_archived_predictions(archive_dir):
+            records[record["id"]] = record
+
+    cursor = conn.cursor()
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    cursor.execute(f'SELECT {", ".join(PREDICTION_COLUMNS)} FROM predictions')
+    for row in cursor.fetchall():
+        records[row[0]] = dict(zip(PREDICTION_COLUMNS, row))
+    return list(records.values())
+
+
+def export_predictions_csv(output_csv, include_archive=True):
+    """
+    Export live and archived predictions in the layout of datasets/predictions.csv,
+    which load_and_preprocess_multiple reads for retraining.
+    """
+    conn = get_db_connection()
+    try:
+        records = load_all_predictions(conn, include_archive=include_archive)
+    finally:
+        conn.close()
+
+    with open(output_csv, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=PREDICTION_COLUMNS)
+        writer.writeheader()
+        writer.writerows(records)
+    print(f"Exported {len(records)} predictions to {output_csv}")
+    return len(records)
+
+
+# Entry point for scheduled maintenance (e.g. from cron)
+if __name__ == '__main__':
+    init_db()
+    run_maintenance()
@@ -0,0 +1,119 @@
+import glob
+import os
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows, where only the single-process development server runs
+    fcntl = None
+from prometheus_client import Counter, Summary, CollectorRegistry, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.mmap_dict import MmapedDict
+
+# Set by the production server (see server.py) before this module is imported. Each worker
+# then writes its metrics to memory-mapped files in this directory instead of process memory.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Metric types whose values are summed over processes, so the files of exited workers can be
+# folded into one <type>_archive.db file instead of piling up with every worker restart
+MERGED_TYPES = ('counter', 'summary', 'histogram')
+
+# Metrics
+prediction_count = Counter('predictions_total', 'Number of predictions made', ['category'])
+correct_predictions = Counter('correct_predictions_total', 'Number of correct predictions', ['category'])
+incorrect_predictions = Counter('incorrect_predictions_total', 'Number of incorrect predictions', ['category'])
+prediction_confidence = Summary('prediction_confidence', 'Prediction confidence values')
+
+
+class AccuracyCollector:
+    """
+    Reports model_accuracy, derived at scrape time from the correct and incorrect
+    prediction counters. Computing it from the (aggregated) counters keeps the value
+    consistent across workers, where a per-worker gauge would only see its own share.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def collect(self):
+        totals = {'correct_predictions': 0.0, 'incorrect_predictions': 0.0}
+        for source in self.sources:
+            for family in source.collect():
+                if family.name in totals:
+                    totals[family.name] += sum(
+                        sample.value for sample in family.samples if sample.name.endswith('_total')
+                    )
+
+        gauge = GaugeMetricFamily('model_accuracy', 'Model accuracy')
+        total = totals['correct_predictions'] + totals['incorrect_predictions']
+        if total > 0:
+            gauge.add_metric([], totals['correct_predictions'] / total)
+        yield gauge
+
+
+if MULTIPROC_DIR is None:
+    REGISTRY.register(AccuracyCollector([correct_predictions, incorrect_predictions]))
+
+
+def generate_metrics():
+    """Render the metrics of this process, or of all worker processes in multiprocess mode."""
+    if MULTIPROC_DIR is None:
+        return generate_latest(REGISTRY)
+
+    # Aggregate the files of all current and past workers at scrape time
+    registry = CollectorRegistry()
+    collector = multiprocess.MultiProcessCollector(registry)
+    registry.register(AccuracyCollector([collector]))
+    with merge_lock(MULTIPROC_DIR, exclusive=False):
+        return generate_latest(registry)
+
+
+def prepare_multiproc_dir(path):
+    """Create the metrics directory and remove files left by a previous run."""
+    os.makedirs(path, exist_ok=True)
+    for filename in glob.glob(os.path.join(path, '*.db')):
+        os.remove(filename)
+
+
+@contextmanager
+def merge_lock(path, exclusive):
+    """
+    Lock shared by scrapes and held exclusively while an exited worker's files are merged, so no
+    scrape sees that worker's values both in its own files and in the archive (or in neither).
+    """
+    with open(os.path.join(path, 'merge.lock'), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield  # Released when the file is closed
+
+
+def merge_worker_files(pid, path):
+    """
+    Add the counter, summary and histogram values of an exited worker to the archive files
+    and delete its files, so the totals are kept while the directory stays small.
+
+    :param pid: Process ID of the exited worker.
+    :param path: Metrics directory.
+    :return: Number of merged files.
+    """
+    merged = 0
+    with merge_lock(path, exclusive=True):
+        for typ in MERGED_TYPES:
+            worker_filename = os.path.join(path, f'{typ}_{pid}.db')
+            if not os.path.exists(worker_filename):
+                continue
+            archive = MmapedDict(os.path.join(path, f'{typ}_archive.db'))
+            try:
+                for key, value, *_ in MmapedDict.read_all_values_from_file(worker_filename):
+                    archive.write_value(key, archive.read_value(key)[0] + value, 0.0)
+            finally:
+                archive.close()
+            os.remove(worker_filename)
+            merged += 1
+    return merged
+
+
+def mark_worker_dead(pid):
+    """Clean up after a worker that has exited: merge its totals and drop its live gauges."""
+    if MULTIPROC_DIR is not None:
+        merge_worker_files(pid, MULTIPROC_DIR)
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
@@ -1,8 +1,16 @@
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
+from lime.lime_text import LimeTextExplainer
 import joblib
 import numpy as np
+import scipy.sparse as sp
+
+# Labels the streaming model can predict; partial_fit needs them all up front
+ISSUE_LABELS = ['bug', 'enhancement', 'question']
 
 
 def custom_tokenizer(text):
@@ -19,6 +27,100 @@ def create_model():
     return model
 
 
+class StreamingTfidfVectorizer(BaseEstimator, TransformerMixin):
+    """
+    TF-IDF vectorizer that can be fitted chunk by chunk.
+
+    Words are mapped to columns with a stateless HashingVectorizer, so there is no
+    vocabulary to hold in memory, and the document frequencies behind the IDF weights are
+    updated by every call to partial_fit. The IDF uses the same smoothed formula and L2
+    normalisation as TfidfVectorizer's defaults.
+    """
+
+    def __init__(self, n_features=2 ** 20):
+        self.n_features = n_features
+
+    def _hasher(self):
+        return HashingVectorizer(n_features=self.n_features, alternate_sign=False, norm=None)
+
+    def partial_fit(self, X, y=None):
+        """Update the document frequencies with a chunk of texts."""
+        if not hasattr(self, 'doc_freq_'):
+            self.doc_freq_ = np.zeros(self.n_features)
+            self.n_docs_ = 0
+        counts = self._hasher().transform(X)
+        self.doc_freq_ += np.bincount(counts.indices, minlength=self.n_features)
+        self.n_docs_ += counts.shape[0]
+        self._update_idf()
+        return self
+
+    def fit(self, X, y=None):
+        for attribute in ('doc_freq_', 'n_docs_'):
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        return self.partial_fit(X)
+
+    def _update_idf(self):
+        # Computed once per fit, not per transform: it spans all n_features columns
+        self.idf_ = np.log((1 + self.n_docs_) / (1 + self.doc_freq_)) + 1
+
+    def transform(self, X):
+        if not hasattr(self, 'idf_'):  # Models saved before idf_ was stored
+            self._update_idf()
+        counts = self._hasher().transform(X)
+        # Scale each stored count by its column's IDF instead of multiplying by a diagonal matrix
+        counts.data *= self.idf_[counts.indices]
+        return normalize(counts, norm='l2')
+
+
+def create_streaming_model():
+    """
+    Create a pipeline that can be trained out of core with partial_fit_model: a hashing
+    TF-IDF vectorizer and a logistic-regression SGDClassifier. It keeps the 'tfidf' and
+    'classifier' step names so the serving code can use it like create_model's pipeline.
+    """
+    model = Pipeline([
+        ("tfidf", StreamingTfidfVectorizer()),
+        ("classifier", SGDClassifier(loss='log_loss', alpha=1e-5, random_state=42))
+    ])
+    return model
+
+
+def partial_fit_model(model, X_chunk, y_chunk, classes=ISSUE_LABELS, update_idf=True):
+    """
+    Update a streaming model with one chunk of training data.
+
+    The IDF weights are updated before the chunk is vectorized, so earlier chunks were seen
+    with slightly older weights; with large corpora the document frequencies settle quickly.
+
+    :param model: Pipeline from create_streaming_model (new or previously trained).
+    :param X_chunk: Texts in the chunk.
+    :param y_chunk: Labels in the chunk.
+    :param classes: Every label the model can predict.
+    :param update_idf: Count the chunk's documents in the IDF; turn off when revisiting data in later epochs.
+    """
+    tfidf_step = model.named_steps['tfidf']
+    classifier_step = model.named_steps['classifier']
+    if update_idf:
+        tfidf_step.partial_fit(X_chunk)
+    classifier_step.partial_fit(tfidf_step.transform(X_chunk), y_chunk, classes=classes)
+
+
+def prepare_for_serving(model):
+    """
+    Lay out the weights of a linear classifier for fast predictions on single sparse rows.
+
+    scikit-learn scores sparse input with ``X @ coef_.T``; with the streaming model's 2**20
+    columns, a C-ordered coef_ is copied on every call. A Fortran-ordered copy makes the
+    product read it in place. partial_fit needs C order again, so only call this on models
+    that are served, not trained further.
+    """
+    classifier_step = model.named_steps['classifier']
+    if isinstance(getattr(classifier_step, 'coef_', None), np.ndarray):
+        classifier_step.coef_ = np.asfortranarray(classifier_step.coef_)
+    return model
+
+
 def train_model(model, X_train, y_train):
     """Train the pipeline model with training data."""
     model.fit(X_train, y_train)
@@ -72,3 +174,98 @@ def get_important_features_from_text(input_text):
         for idx in sorted_indices[:10]
     ]
     return top_features
+
+
+def get_lime_explanation(model, preprocessed_text, num_features=10, label=None):
+    """
+    Explain a prediction with LIME by scoring randomly perturbed copies of the text.
+
+    :param model: Fitted pipeline with 'tfidf' and 'classifier' steps.
+    :param preprocessed_text: Preprocessed tokens joined by spaces.
+    :param num_features: Number of words to return.
+    :param label: Index of the class to explain. Defaults to LIME's default label.
+    :return: List of (word, weight) tuples.
+    """
+    class_names = model.named_steps['classifier'].classes_.tolist()
+    explainer = LimeTextExplainer(class_names=class_names)
+    if label is None:
+        explanation = explainer.explain_instance(
+            preprocessed_text,
+            model.predict_proba,
+            num_features=num_features
+        )
+        return explanation.as_list()
+    explanation = explainer.explain_instance(
+        preprocessed_text,
+        model.predict_proba,
+        num_features=num_features,
+        labels=(label,)
+    )
+    return explanation.as_list(label=label)
+
+
+def get_tree_explanation(model, preprocessed_text, num_features=10, label=None):
+    """
+    Explain a prediction from the decision paths of the fitted random forest.
+
+    Every split on the path from the root to the leaf moves the predicted class
+    probability; the change is credited to the word the node splits on, so the result is
+    deterministic. Averaged over all trees, the root probability (the class prior) plus
+    all contributions equals predict_proba. Only words present in the text are returned:
+    the prior and the contributions of splits on words absent from the text are left
+    unattributed, so the returned weights need not sum to the predicted probability.
+
+    :param model: Fitted pipeline with 'tfidf' and 'classifier' steps.
+    :param preprocessed_text: Preprocessed tokens joined by spaces.
+    :param num_features: Number of words to return.
+    :param label: Index of the class to explain. Defaults to the predicted class.
+    :return: List of (word, weight) tuples, sorted by absolute weight.
+    """
+    tfidf_step = model.named_steps['tfidf']
+    classifier_step = model.named_steps['classifier']
+    if not hasattr(classifier_step, 'estimators_'):
+        raise ValueError("Tree explanations require a tree ensemble classifier.")
+
+    X = tfidf_step.transform([preprocessed_text])
+    if label is None:
+        label = int(np.argmax(classifier_step.predict_proba(X)[0]))
+
+    # Node indicator for every tree at once; n_nodes_ptr delimits each tree's nodes
+    indicator, n_nodes_ptr = classifier_step.decision_path(X)
+    nodes = indicator.indices
+
+    contributions = np.zeros(X.shape[1])
+    for tree_idx, estimator in enumerate(classifier_step.estimators_):
+        tree = estimator.tree_
+        start, end = n_nodes_ptr[tree_idx], n_nodes_ptr[tree_idx + 1]
+        # Children always have higher node IDs than their parent, so sorted IDs are the path
+        path = np.sort(nodes[(nodes >= start) & (nodes < end)] - start)
+        values = tree.value[path, 0, :]
+        probs = values[:, label] / values.sum(axis=1)
+        features = tree.feature[path[:-1]]
+        np.add.at(contributions, features, np.diff(probs))
+    contributions /= len(classifier_step.estimators_)
+
+    feature_names = tfidf_step.get_feature_names_out()
+    present = X.indices[contributions[X.indices] != 0]
+    order = np.argsort(-np.abs(contributions[present]), kind='stable')
+    return [(str(feature_names[idx]), float(contributions[idx])) for idx in present[order][:num_features]]
+
+
+# Explanation engines selectable on /api/predict and /api/explain
+EXPLAINERS = {
+    'lime': get_lime_explanation,
+    'tree': get_tree_explanation,
+}
+
+
+def explain_text(model, preprocessed_text, method='lime', num_features=10):
+    """
+    Explain a prediction with the given engine ('lime' or 'tree').
+
+    Both engines explain the predicted class, so their results can be compared directly.
+    """
+    if method not in EXPLAINERS:
+        raise ValueError(f"Unknown explainer '{method}'. Choose one of: {', '.join(EXPLAINERS)}.")
+    label = int(np.argmax(model.predict_proba([preprocessed_text])[0]))
+    return EXPLAINERS[method](model, preprocessed_text, num_features=num_features, label=label)
@@ -1,4 +1,5 @@
 import gzip
+import os
 import pandas as pd
 import re
 import nltk
@@ -18,6 +19,24 @@ nltk.download('wordnet')
 stop_words = set(stopwords.words('english'))
 lemmatizer = WordNetLemmatizer()
 
+# Input budget, so very long issue bodies (pasted logs, stack traces) have bounded cost
+MAX_INPUT_CHARS = int(os.environ.get('PREPROCESS_MAX_CHARS', 20000))  # Characters kept after collapsing lines
+MAX_TOKENS = int(os.environ.get('PREPROCESS_MAX_TOKENS', 1000))  # Tokens passed to POS tagging and the model
+MAX_REPEATED_LINES = int(os.environ.get('PREPROCESS_MAX_REPEATED_LINES', 5))  # Lines kept per log/trace block
+HEAD_FRACTION = 0.75  # Share of the budget taken from the start of the text; the rest comes from the end
+
+# Lines that look like stack-trace frames or log records
+NOISE_LINE = re.compile(
+    r'^\s*(?:'
+    r'(?P<frame>at\s+[\w$.<>/]+\(.*\)'                      # Java / JavaScript frames
+    r'|File ".*", line \d+.*'                               # Python frames
+    r'|\.\.\. \d+ more'                                     # Java elided frames
+    r'|#\d+\s+0x[0-9a-fA-F]+.*)'                             # Native backtraces
+    r'|(?P<log>\[?\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}.*'   # Timestamped log lines
+    r'|\[?(?:TRACE|DEBUG|INFO|WARN|WARNING|ERROR|FATAL)\]?[\s:].*)'  # Log level prefixes
+    r')$'
+)
+
 
 # Function to clean text (remove URLs, mentions, hashtags, and special characters)
 def clean_text(text):
@@ -75,14 +94,111 @@ def count_records_by_category(df, category_column='issue_label'):
         print(f"No '{category_column}' column found for counting categories.")
 
 
+# Function to collapse stack traces, log output and repeated lines
+def collapse_repetitive_lines(text, max_repeated_lines=MAX_REPEATED_LINES):
+    """
+    Shorten every block of consecutive stack-trace/log lines, or of lines that only differ
+    in numbers, to its first max_repeated_lines - 1 lines and its last line.
+    Sizes of lines outside such blocks are left as they are.
+
+    :return: Tuple of (collapsed text, number of lines removed).
+    """
+    lines = text.splitlines()
+    kept = []
+    removed = 0
+    block = []
+    block_kind = None
+    previous_signature = None
+
+    def flush():
+        nonlocal removed
+        if len(block) > max_repeated_lines:
+            kept.extend(block[:max_repeated_lines - 1])
+            kept.append(block[-1])
+            removed += len(block) - max_repeated_lines
+        else:
+            kept.extend(block)
+        block.clear()
+
+    for line in lines:
+        signature = re.sub(r'0x[0-9a-fA-F]+|\d+', '0', line.strip())
+        match = NOISE_LINE.match(line)
+        if match:
+            kind = match.lastgroup
+        elif block and line[:1].isspace() and line.strip():
+            # Indented lines after a frame (e.g. the source line in Python tracebacks) belong to the block
+            kind = block_kind
+        elif signature and signature == previous_signature:
+            kind = 'repeat'
+        else:
+            kind = None
+
+        if kind != block_kind:
+            flush()
+        if kind is None:
+            kept.append(line)
+        else:
+            block.append(line)
+        block_kind = kind
+        previous_signature = signature
+    flush()
+    return '\n'.join(kept), removed
+
+
+def select_head_tail(items, limit, head_fraction=HEAD_FRACTION):
+    """Keep the first and last items of a sequence so that at most limit remain, preserving order."""
+    if limit is None or len(items) <= limit:
+        return items
+    head = int(limit * head_fraction)
+    tail = limit - head
+    return items[:head] + (items[-tail:] if tail else items[:0])
+
+
+def apply_input_budget(text, max_chars=MAX_INPUT_CHARS, max_repeated_lines=MAX_REPEATED_LINES):
+    """
+    Bound the size of a raw issue text before the expensive preprocessing steps.
+
+    :return: Tuple of (bounded text, report dictionary).
+    """
+    report = {"original_chars": len(text), "collapsed_lines": 0, "dropped_chars": 0}
+    if max_repeated_lines:
+        text, report["collapsed_lines"] = collapse_repetitive_lines(text, max_repeated_lines)
+    if max_chars is not None and len(text) > max_chars:
+        before = len(text)
+        # Cut at word boundaries; a slice that is only whitespace contributes nothing
+        head = text[:int(max_chars * HEAD_FRACTION)].rsplit(None, 1)
+        tail = text[len(text) - (max_chars - int(max_chars * HEAD_FRACTION)):].split(None, 1)
+        text = (head[0] if head else '') + '\n' + (tail[-1] if tail else '')
+        report["dropped_chars"] = before - len(text)
+    return text, report
+
+
+def preprocess_text_with_report(text, max_chars=MAX_INPUT_CHARS, max_tokens=MAX_TOKENS,
+                                max_repeated_lines=MAX_REPEATED_LINES):
+    """
+    Preprocess a single string within the input budget.
+
+    :return: Tuple of (tokens, report) where the report describes what was cut.
+    """
+    text, report = apply_input_budget(text, max_chars=max_chars, max_repeated_lines=max_repeated_lines)
+    text = text.lower()
+    text = clean_text(text)
+    tokens = tokenize_and_remove_stopwords(text)
+    report["original_tokens"] = len(tokens)
+    tokens = select_head_tail(tokens, max_tokens)
+    report["kept_tokens"] = len(tokens)
+    report["truncated"] = bool(
+        report["collapsed_lines"] or report["dropped_chars"] or report["kept_tokens"] < report["original_tokens"]
+    )
+    tokens = lemmatize_tokens(tokens)
+    return tokens, report
+
+
 # Main preprocessing function
 def preprocess_text(input_data):
     if isinstance(input_data, str):
         # Handle single string input
-        text = input_data.lower()
-        text = clean_text(text)
-        tokens = tokenize_and_remove_stopwords(text)
-        tokens = lemmatize_tokens(tokens)
+        tokens, _ = preprocess_text_with_report(input_data)
         return tokens
 
     elif isinstance(input_data, list) or isinstance(input_data, pd.DataFrame):
@@ -97,8 +213,9 @@ def preprocess_text(input_data):
             df['issue_title'] = ''
             df['issue_body'] = ''
 
-        # Combine `title` and `body` into `text`
+        # Combine `title` and `body` into `text`, bounded by the same input budget as single strings
         df['text'] = df['issue_title'] + ' ' + df['issue_body']
+        df['text'] = df['text'].apply(lambda text: apply_input_budget(str(text))[0])
 
         # Normalize and clean the text
         df['text'] = df['text'].str.encode('ascii', 'ignore').str.decode('ascii')
@@ -107,6 +224,7 @@ def preprocess_text(input_data):
 
         # Tokenize, remove stopwords, and lemmatize
         df['tokens'] = df['text'].apply(tokenize_and_remove_stopwords)
+        df['tokens'] = df['tokens'].apply(lambda tokens: select_head_tail(tokens, MAX_TOKENS))
         df['tokens'] = df['tokens'].apply(lemmatize_tokens)
 
         # Remove illegal characters from the entire DataFrame
@@ -118,79 +236,110 @@ def preprocess_text(input_data):
         raise ValueError("Invalid input format. Provide a string, list, or DataFrame.")
 
 
-# Function to load and preprocess multiple data sources
-def load_and_preprocess_multiple(data_sources, output_xls=r'C:\ws2024-principles-of-ai-engineering\preprocessed_combined.xlsx'):
-    # List to store processed DataFrames
-    dataframes = []
-
-    # Define a mapping for renaming columns
-    column_mappings = {
-        "sample1.csv.gz": {
-            "issue_label": "issue_label",
-            "issue_title": "issue_title",
-            "issue_body": "issue_body",
-            "issue_created_at": "issue_created_at"
-        },
-        "sample2.csv.gz": {
-            "issue_label": "issue_label",
-            "issue_title": "issue_title",
-            "issue_body": "issue_body",
-            "issue_created_at": "issue_created_at"
-        },
-        "predictions.csv": {
-            "title": "issue_title",
-            "body": "issue_body",
-            "corrected_label": "issue_label",
-            "timestamp": "issue_created_at"
-        }
+# Column renames per source file, so every source matches the sample datasets' layout
+COLUMN_MAPPINGS = {
+    "sample1.csv.gz": {
+        "issue_label": "issue_label",
+        "issue_title": "issue_title",
+        "issue_body": "issue_body",
+        "issue_created_at": "issue_created_at"
+    },
+    "sample2.csv.gz": {
+        "issue_label": "issue_label",
+        "issue_title": "issue_title",
+        "issue_body": "issue_body",
+        "issue_created_at": "issue_created_at"
+    },
+    "predictions.csv": {
+        "title": "issue_title",
+        "body": "issue_body",
+        "corrected_label": "issue_label",
+        "timestamp": "issue_created_at"
     }
+}
+
+# Columns every source is reduced to, in this order
+FINAL_COLUMNS = [
+    "issue_url", "issue_label", "issue_created_at", "issue_author_association",
+    "repository_url", "issue_title", "issue_body"
+]
 
-    # Load and normalize each data source
-    for source in data_sources:
-        if source.endswith('.gz'):
-            with gzip.open(source, 'rt', encoding='ISO-8859-1') as f:
-                df = pd.read_csv(f)
-        else:
-            df = pd.read_csv(source, encoding='ISO-8859-1')
 
-        # Get the filename to apply the appropriate column mapping
-        filename = source.split("\\")[-1]  # Adjust path separator as needed
-        if filename in column_mappings:
-            df.rename(columns=column_mappings[filename], inplace=True)
+def read_source(source, chunksize=None):
+    """Read a data source; with a chunksize, return an iterator over DataFrames of that many rows."""
+    if source.endswith('.ndjson.gz'):
+        # Archived predictions (see db.archive_old_predictions)
+        return pd.read_json(source, lines=True, compression='gzip', chunksize=chunksize)
+    if source.endswith('.gz'):
+        return pd.read_csv(source, compression='gzip', encoding='ISO-8859-1', chunksize=chunksize)
+    return pd.read_csv(source, encoding='ISO-8859-1', chunksize=chunksize)
 
-        # Add missing columns to ensure consistent structure
-        required_columns = [
-            "issue_url", "issue_label", "issue_created_at", "issue_author_association",
-            "repository_url", "issue_title", "issue_body"
-        ]
-        for col in required_columns:
-            if col not in df.columns:
-                df[col] = None  # Fill missing columns with None
 
-        # Add to the list of DataFrames
-        dataframes.append(df)
+def normalize_columns(df, source):
+    """Rename a source's columns to the common layout and reduce it to FINAL_COLUMNS."""
+    # Get the filename to apply the appropriate column mapping (Windows-style paths work on any platform)
+    filename = os.path.basename(source.replace("\\", "/"))
+    if filename.startswith('predictions-') and filename.endswith('.ndjson.gz'):
+        filename = "predictions.csv"  # Archives share the predictions table layout
+    if filename in COLUMN_MAPPINGS:
+        df = df.rename(columns=COLUMN_MAPPINGS[filename])
+
+    # Add missing columns to ensure consistent structure
+    for col in FINAL_COLUMNS:
+        if col not in df.columns:
+            df[col] = None  # Fill missing columns with None
+    return df[FINAL_COLUMNS]
+
+
+# Function to load and preprocess multiple data sources
+def load_and_preprocess_multiple(data_sources, output_xls=r'C:\ws2024-principles-of-ai-engineering\preprocessed_combined.xlsx'):
+    # Load and normalize each data source
+    dataframes = [normalize_columns(read_source(source), source) for source in data_sources]
 
     # Combine all DataFrames
     combined_df = pd.concat(dataframes, ignore_index=True)
 
-    # Ensure the final DataFrame has only the required columns in the correct order
-    final_columns = [
-        "issue_url", "issue_label", "issue_created_at", "issue_author_association",
-        "repository_url", "issue_title", "issue_body"
-    ]
-    combined_df = combined_df[final_columns]
-
     # Preprocess the combined data
     preprocessed_df = preprocess_text(combined_df)
 
     # Save the preprocessed data
-    preprocessed_df.to_excel(output_xls, index=False, engine='openpyxl')
+    if output_xls.endswith('.csv'):
+        preprocessed_df.to_csv(output_xls, index=False)
+    else:
+        preprocessed_df.to_excel(output_xls, index=False, engine='openpyxl')
     print(f"Preprocessed data saved to {output_xls}")
 
     # Count records per category
     count_records_by_category(preprocessed_df)
 
 
+def preprocess_to_csv_in_chunks(data_sources, output_csv, chunk_size=10000):
+    """
+    Preprocess data sources chunk by chunk and append the results to one CSV file, so corpora
+    larger than memory can be prepared for train.py --streaming.
+
+    :param data_sources: Paths of the source files (same formats as load_and_preprocess_multiple).
+    :param output_csv: CSV file to write; an existing file is replaced.
+    :param chunk_size: Rows read, preprocessed and written at a time.
+    :return: Number of rows written.
+    """
+    rows = 0
+    category_counts = pd.Series(dtype='int64')
+    for source in data_sources:
+        with read_source(source, chunksize=chunk_size) as reader:
+            for chunk in reader:
+                preprocessed_df = preprocess_text(normalize_columns(chunk, source))
+                preprocessed_df.to_csv(output_csv, mode='w' if rows == 0 else 'a', header=(rows == 0), index=False)
+                rows += len(preprocessed_df)
+                category_counts = category_counts.add(preprocessed_df['issue_label'].value_counts(), fill_value=0)
+    print(f"Preprocessed {rows} rows saved to {output_csv}")
+
+    print("\nRecord counts by category:")
+    for category, count in category_counts.sort_values(ascending=False).items():
+        print(f"{category}: {int(count)}")
+    return rows
+
+
 # Entry point for standalone usage
 if __name__ == '__main__':
     data_sources = [
@@ -1,4 +1,84 @@
-from app import app
+import gc
+import os
+import sys
+import tempfile
+
+
+def server_options():
+    """Production server settings, configurable through environment variables."""
+    return {
+        "bind": os.environ.get("SERVER_BIND", "0.0.0.0:5000"),
+        "workers": int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) + 1)),
+        "threads": int(os.environ.get("SERVER_THREADS", 1)),
+        "timeout": int(os.environ.get("SERVER_TIMEOUT", 60)),  # Kill workers silent for this many seconds
+        "graceful_timeout": int(os.environ.get("SERVER_GRACEFUL_TIMEOUT", 30)),  # Time to finish requests on restart
+        "keepalive": int(os.environ.get("SERVER_KEEPALIVE", 5)),
+        # Recycle each worker after this many requests (jittered so they don't restart together)
+        "max_requests": int(os.environ.get("SERVER_MAX_REQUESTS", 1000)),
+        "max_requests_jitter": int(os.environ.get("SERVER_MAX_REQUESTS_JITTER", 100)),
+        # Import the app (model, NLTK data) once in the parent and fork workers from it
+        "preload_app": True,
+        "post_fork": post_fork,
+        "child_exit": child_exit,
+    }
+
+
+def post_fork(server, worker):
+    # Every worker archives, compacts and prunes its own similarity index; archiving runs in a
+    # write transaction, so concurrent runs are safe (the later ones find nothing to archive)
+    from app import start_maintenance_thread
+    start_maintenance_thread()
+
+
+def child_exit(server, worker):
+    # Fold the worker's metric files into the archive files and drop its live gauges
+    from metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
+
+
+def run_production_server(options):
+    """Run the app under gunicorn, which needs a POSIX system (use --dev on Windows)."""
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        """
+        Pre-fork server for the Flask app.
+
+        The app is loaded and warmed up once in the parent process; workers are forked from it
+        and share that memory copy-on-write. Send SIGHUP to the parent to gracefully replace
+        all workers, SIGTTIN/SIGTTOU to add or remove one, and SIGTERM to shut down.
+        """
+
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from app import app  # Loads the model, NLTK data and runs the warm-up
+            # Move everything loaded so far out of the garbage collector's reach, so collections
+            # in the workers don't touch (and copy) the shared pages
+            gc.freeze()
+            return app
+
+    ProductionServer(options).run()
+
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    if "--dev" in sys.argv:
+        # Single-process Werkzeug server with the reloader, for local development
+        from app import app, start_maintenance_thread
+        start_maintenance_thread()
+        app.run(debug=True)
+    else:
+        # Workers write metrics to memory-mapped files that /metrics aggregates; this must be
+        # set, and the files of the previous run removed, before prometheus_client is imported
+        metrics_dir = os.environ.setdefault(
+            "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "issue-prediction-metrics")
+        )
+        from metrics import prepare_multiproc_dir
+        prepare_multiproc_dir(metrics_dir)
+        run_production_server(server_options())
@@ -0,0 +1,358 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import joblib
+import numpy as np
+import scipy.sparse as sp
+from db import DB_NAME
+
+# The index is persisted next to the SQLite database
+INDEX_NAME = os.path.splitext(DB_NAME)[0] + '_index.pkl'
+
+# Bumped when the hashing scheme changes; older index files are rebuilt from the database
+INDEX_VERSION = 3
+
+# Hyperplane rows kept for the most recently hashed feature columns (160 floats each, ~20 MB in total);
+# rarer columns are regenerated from their column number when needed
+PLANE_CACHE_SIZE = 2 ** 15
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest-neighbour index over TF-IDF vectors.
+
+    Uses random-projection LSH: every vector is hashed into one bucket per table by the
+    signs of its projections onto ``n_bits`` random hyperplanes. The hyperplane components
+    of a feature are generated from its column number when first needed, so the index also
+    works with hashed feature spaces of millions of columns. A query only scores the
+    issues that share a bucket (or a bucket one bit away) with it, so lookups stay
+    sublinear in the number of stored predictions. ``exact=True`` scores every stored
+    vector instead and is meant for validating recall.
+    """
+
+    def __init__(self, n_features, n_tables=16, n_bits=10, seed=42, fingerprint=None):
+        self.n_features = n_features
+        self.fingerprint = fingerprint
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.version = INDEX_VERSION
+        self.buckets = [{} for _ in range(n_tables)]
+        self.ids = []
+        self.positions = {}
+        # Stored vectors as a growable CSR buffer; appending a row is amortised O(row size)
+        self._data = np.zeros(1024)
+        self._indices = np.zeros(1024, dtype=np.int32)
+        self._indptr = np.zeros(1025, dtype=np.int64)
+        self._nnz = 0
+        self.last_rowid = 0
+        self.last_id = None
+        self.unsaved = 0
+        self._planes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, issue_id):
+        return issue_id in self.positions
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        state['_data'] = self._data[:self._nnz].copy()
+        state['_indices'] = self._indices[:self._nnz].copy()
+        state['_indptr'] = self._indptr[:len(self.ids) + 1].copy()
+        state['_planes'] = OrderedDict()
+        state['unsaved'] = 0
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('last_rowid', 0)
+        state.setdefault('last_id', None)
+        state.setdefault('version', 1)
+        state.setdefault('fingerprint', None)
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _plane_rows(self, features):
+        """Return the hyperplane components of the given feature columns, generating missing ones."""
+        rows = np.empty((len(features), self.n_tables * self.n_bits), dtype=np.float32)
+        for i, feature in enumerate(features):
+            feature = int(feature)
+            row = self._planes.get(feature)
+            if row is None:
+                rng = np.random.default_rng([self.seed, feature])
+                row = rng.standard_normal(self.n_tables * self.n_bits).astype(np.float32)
+                self._planes[feature] = row
+                if len(self._planes) > PLANE_CACHE_SIZE:
+                    self._planes.popitem(last=False)
+            else:
+                self._planes.move_to_end(feature)
+            rows[i] = row
+        return rows
+
+    def _hash(self, vector):
+        """Return one integer bucket key per table for a (1, n_features) sparse vector."""
+        projections = vector.data @ self._plane_rows(vector.indices)
+        bits = projections.reshape(self.n_tables, self.n_bits) > 0
+        weights = 1 << np.arange(self.n_bits)
+        return (bits * weights).sum(axis=1).tolist()
+
+    def _matrix(self):
+        """Return a (no-copy) CSR view of every stored vector, one row per position."""
+        n_rows = len(self.ids)
+        return sp.csr_matrix(
+            (self._data[:self._nnz], self._indices[:self._nnz], self._indptr[:n_rows + 1]),
+            shape=(n_rows, self.n_features)
+        )
+
+    def _append_row(self, vector):
+        n_rows = len(self.ids)
+        end = self._nnz + vector.nnz
+        if end > len(self._data):
+            capacity = max(end, 2 * len(self._data))
+            self._data = np.resize(self._data, capacity)
+            self._indices = np.resize(self._indices, capacity)
+        if n_rows + 2 > len(self._indptr):
+            self._indptr = np.resize(self._indptr, 2 * len(self._indptr))
+        self._data[self._nnz:end] = vector.data
+        self._indices[self._nnz:end] = vector.indices
+        self._indptr[n_rows + 1] = end
+        self._nnz = end
+
+    def add(self, issue_id, vector):
+        """Insert the TF-IDF vector of a stored prediction. Already indexed IDs are ignored."""
+        vector = sp.csr_matrix(vector)
+        with self._lock:
+            if issue_id in self.positions:
+                return
+            position = len(self.ids)
+            self._append_row(vector)
+            self.ids.append(issue_id)
+            self.positions[issue_id] = position
+            for table, key in enumerate(self._hash(vector)):
+                self.buckets[table].setdefault(key, []).append(position)
+            self.unsaved += 1
+
+    def remove(self, issue_ids):
+        """
+        Drop issues from the index, e.g. after they were archived. Unknown IDs are ignored.
+
+        Removed rows are left as gaps in the stored vectors until they make up half of
+        them; the index is then compacted.
+
+        :return: Number of issues removed.
+        """
+        removed = 0
+        with self._lock:
+            matrix = self._matrix()
+            for issue_id in issue_ids:
+                position = self.positions.pop(issue_id, None)
+                if position is None:
+                    continue
+                for table, key in enumerate(self._hash(matrix[position])):
+                    bucket = self.buckets[table][key]
+                    bucket.remove(position)
+                    if not bucket:
+                        del self.buckets[table][key]
+                self.ids[position] = None
+                removed += 1
+            if removed:
+                self.unsaved += removed
+                if len(self.ids) - len(self.positions) > len(self.ids) // 2:
+                    self._compact()
+        return removed
+
+    def _compact(self):
+        """Drop the gaps left by removed issues and renumber the remaining positions."""
+        live = [position for position, issue_id in enumerate(self.ids) if issue_id is not None]
+        matrix = self._matrix()[live]
+        new_positions = np.full(len(self.ids), -1, dtype=np.int64)
+        new_positions[live] = np.arange(len(live))
+
+        self._data = matrix.data
+        self._indices = matrix.indices.astype(np.int32)
+        self._indptr = matrix.indptr.astype(np.int64)
+        self._nnz = matrix.nnz
+        self.ids = [self.ids[position] for position in live]
+        self.positions = {issue_id: position for position, issue_id in enumerate(self.ids)}
+        self.buckets = [
+            {key: new_positions[bucket].tolist() for key, bucket in table.items()}
+            for table in self.buckets
+        ]
+
+    def candidates(self, vector):
+        """Collect positions that share a bucket, or a bucket one bit away, with the vector."""
+        found = set()
+        for table, key in enumerate(self._hash(vector)):
+            bucket = self.buckets[table]
+            found.update(bucket.get(key, ()))
+            for bit in range(self.n_bits):
+                found.update(bucket.get(key ^ (1 << bit), ()))
+        return found
+
+    def query(self, vector, k=5, exact=False, exclude=None):
+        """
+        Find the k stored issues most similar to the given vector.
+
+        :param vector: (1, n_features) TF-IDF vector of the query text.
+        :param k: Number of neighbours to return.
+        :param exact: Score every stored vector instead of the LSH candidates.
+        :param exclude: Optional issue ID to leave out of the results.
+        :return: List of (issue_id, cosine_similarity) tuples, best first.
+        """
+        vector = sp.csr_matrix(vector)
+        with self._lock:
+            if exact:
+                positions = np.arange(len(self.ids))
+            else:
+                positions = np.fromiter(self.candidates(vector), dtype=np.int64)
+            if len(positions) == 0:
+                return []
+
+            # Only the selected rows are scored; TF-IDF rows are L2-normalised, so the dot
+            # product is the cosine similarity
+            matrix = self._matrix()
+            if not exact:
+                matrix = matrix[positions]
+            scores = np.asarray((matrix @ vector.T).todense()).ravel()
+            order = np.argsort(-scores, kind='stable')
+            results = []
+            for idx in order:
+                issue_id = self.ids[positions[idx]]
+                if issue_id is None or issue_id == exclude:
+                    continue
+                results.append((issue_id, float(scores[idx])))
+                if len(results) == k:
+                    break
+            return results
+
+    def vector_for(self, issue_id):
+        """Return the stored vector for an issue ID, or None if it is not indexed."""
+        with self._lock:
+            position = self.positions.get(issue_id)
+            return None if position is None else self._matrix()[position]
+
+    def save(self, index_filename=INDEX_NAME):
+        """Save the index to a file."""
+        with self._lock:
+            # Per-process temp file, so workers saving at the same time don't write into each other's file
+            tmp_filename = f"{index_filename}.{os.getpid()}.tmp"
+            joblib.dump(self, tmp_filename)
+            os.replace(tmp_filename, index_filename)
+            self.unsaved = 0
+
+
+def vectorizer_fingerprint(vectorizer):
+    """
+    Hash the fitted state of a TF-IDF vectorizer: its vocabulary (if it has one) and its document
+    frequencies or IDF weights. Vectors are only comparable within one fingerprint.
+    """
+    digest = hashlib.sha256()
+    vocabulary = getattr(vectorizer, 'vocabulary_', None)
+    if vocabulary is not None:
+        digest.update(repr(sorted((word, int(column)) for word, column in vocabulary.items())).encode())
+    # The streaming vectorizer derives idf_ from doc_freq_ (lazily for older models), so prefer the latter
+    for attribute in ('doc_freq_', 'idf_'):
+        values = getattr(vectorizer, attribute, None)
+        if values is not None:
+            digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+            break
+    return digest.hexdigest()
+
+
+def load_index(n_features, index_filename=INDEX_NAME, fingerprint=None):
+    """
+    Load the index from a file, or start an empty one if it is missing, unreadable or was built
+    for another vectorizer (see vectorizer_fingerprint). An empty index is rebuilt from the
+    database by sync_index.
+    """
+    if os.path.exists(index_filename):
+        try:
+            index = joblib.load(index_filename)
+        except Exception as e:
+            print(f"Similarity index could not be loaded ({e}), rebuilding.")
+            return SimilarityIndex(n_features, fingerprint=fingerprint)
+        if (index.n_features == n_features and index.version == INDEX_VERSION
+                and index.fingerprint == fingerprint):
+            return index
+        print("Similarity index was built for a different vectorizer or version, rebuilding.")
+    return SimilarityIndex(n_features, fingerprint=fingerprint)
+
+
+def sync_index(index, conn, vectorize, vectorize_raw=None):
+    """
+    Add predictions that are in the database but missing from the index.
+
+    Only rows inserted after the last synced rowid are read, and they are vectorized from the
+    preprocessed text stored at insert time, so this is cheap enough to run before every
+    lookup and keeps the indexes of separate worker processes current.
+
+    :param index: SimilarityIndex to update.
+    :param conn: Open database connection.
+    :param vectorize: Callable mapping a stored preprocessed text to its TF-IDF vector.
+    :param vectorize_raw: Optional callable mapping a title and body to its TF-IDF vector, for rows
+                          stored before preprocessed text was kept. Those rows are skipped without it.
+    :return: Number of rows added.
+    """
+    cursor = conn.cursor()
+    if index.last_rowid:
+        # New rows only get rowids above last_rowid while the row that had it is still there. Once it
+        # is deleted (archived), SQLite may hand that rowid and lower ones to new rows, so all rows are
+        # read again; rows that are already indexed are skipped
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        row = cursor.execute('SELECT id FROM predictions WHERE rowid = ?', (index.last_rowid,)).fetchone()
+        if row is None or row[0] != index.last_id:
+            index.last_rowid = 0
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    cursor.execute(
+        'SELECT rowid, id, title, body, preprocessed_text FROM predictions WHERE rowid > ? ORDER BY rowid',
+        (index.last_rowid,)
+    )
+    added = 0
+    for rowid, issue_id, title, body, preprocessed_text in cursor.fetchall():
+        if issue_id not in index:
+            if preprocessed_text is not None:
+                index.add(issue_id, vectorize(preprocessed_text))
+                added += 1
+            elif vectorize_raw is not None:
+                index.add(issue_id, vectorize_raw(title, body))
+                added += 1
+        index.last_rowid, index.last_id = rowid, issue_id
+    return added
+
+
+def prune_index(index, conn):
+    """
+    Remove issues that are no longer in the live table, e.g. because they were archived.
+
+    :param index: SimilarityIndex to update.
+    :param conn: Open database connection.
+    :return: Number of issues removed.
+    """
+    cursor = conn.cursor()
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    cursor.execute('SELECT id FROM predictions')
+    live_ids = {row[0] for row in cursor.fetchall()}
+    return index.remove([issue_id for issue_id in list(index.positions) if issue_id not in live_ids])
+
+
+def recall_at_k(index, vectors, k=5):
+    """
+    Measure how many of the exact top-k neighbours the LSH lookup finds.
+
+    :param index: Populated SimilarityIndex.
+    :param vectors: Query vectors to evaluate.
+    :param k: Number of neighbours per query.
+    :return: Mean recall over all queries.
+    """
+    recalls = []
+    for vector in vectors:
+        exact = {issue_id for issue_id, _ in index.query(vector, k=k, exact=True)}
+        if not exact:
+            continue
+        approx = {issue_id for issue_id, _ in index.query(vector, k=k)}
+        recalls.append(len(exact & approx) / len(exact))
+    return float(np.mean(recalls)) if recalls else 1.0
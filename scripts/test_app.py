@@ -1,4 +1,6 @@
 import pytest
+import datetime
+import os
 from app import app
 import nltk
 from unittest.mock import patch, MagicMock, ANY
@@ -144,3 +146,318 @@ def test_correct_prediction(mock_get_db_connection, client):
 
     # Optionally print to verify output manually (remove in production tests)
     print(json_data)
+
+
+# 6. Test the similarity index finds the same neighbours as the exact search
+def test_similarity_index_matches_exact_search():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from similarity import SimilarityIndex
+
+    texts = [
+        "login crash password long",
+        "login crash password short",
+        "add dark mode setting",
+        "dark mode option setting",
+        "use api python",
+    ]
+    vectors = TfidfVectorizer().fit_transform(texts)
+    index = SimilarityIndex(vectors.shape[1])
+    for i in range(len(texts)):
+        index.add(str(i), vectors[i])
+
+    exact = index.query(vectors[0], k=2, exact=True)
+    approx = index.query(vectors[0], k=2)
+    assert exact[0][0] == '0'
+    assert exact[1][0] == '1'
+    assert [issue_id for issue_id, _ in approx] == [issue_id for issue_id, _ in exact]
+    assert index.query(vectors[0], k=1, exclude='0')[0][0] == '1'
+
+    # Removed (archived) issues are no longer returned, also after the index is compacted
+    assert index.remove(['1', 'unknown']) == 1
+    assert '1' not in index
+    assert '1' not in [issue_id for issue_id, _ in index.query(vectors[0], k=5, exact=True)]
+    assert index.query(vectors[0], k=1, exclude='0') != [('1', ANY)]
+    index.remove(['2', '4'])
+    assert len(index) == 2
+    assert index.query(vectors[3], k=1)[0][0] == '3'
+    assert index.query(vectors[0], k=1)[0][0] == '0'
+
+
+# 7. Test Similar Issues Endpoint
+@patch('app.get_db_connection')
+def test_similar_issues(mock_get_db_connection, client):
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db_connection.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = ("Bug in login system", "bug", None)
+
+    response = client.post('/api/similar', json={
+        "title": "Login crashes",
+        "body": "The login page crashes when the password is too long.",
+        "k": 3,
+        "mode": "exact"
+    })
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['mode'] == 'exact'
+    assert len(json_data['similar_issues']) <= 3
+
+    # Unknown modes and IDs are rejected
+    assert client.post('/api/similar', json={"title": "x", "mode": "fuzzy"}).status_code == 400
+    assert client.post('/api/similar', json={"id": "does-not-exist"}).status_code == 404
+
+    # k must be a positive integer no larger than the cap
+    for k in (0, -1, 51, "5"):
+        assert client.post('/api/similar', json={"title": "x", "k": k}).status_code == 400
+
+
+# 8. Test Explain Endpoint with the Tree Explainer
+def test_explain_with_tree_explainer(client):
+    mock_data = {
+        "title": "Bug in login system",
+        "body": "The login system crashes when password is too long.",
+        "explainer": "tree"
+    }
+    response = client.post('/api/explain', json=mock_data)
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['explainer'] == 'tree'
+
+    # Same (word, weight) shape as LIME, and deterministic across calls
+    for word, weight in json_data['explanation']:
+        assert isinstance(word, str)
+        assert isinstance(weight, float)
+    assert client.post('/api/explain', json=mock_data).get_json()['explanation'] == json_data['explanation']
+
+    # Unknown explainers are rejected
+    mock_data['explainer'] = 'shap'
+    assert client.post('/api/explain', json=mock_data).status_code == 400
+
+    # The tree explainer is rejected up front when the model is not a tree ensemble
+    mock_data['explainer'] = 'tree'
+    with patch('app.AVAILABLE_EXPLAINERS', ['lime']):
+        assert client.post('/api/explain', json=mock_data).status_code == 400
+        assert client.post('/api/predict', json=mock_data).status_code == 400
+
+
+# 9. Test Archiving, Compaction and Reading Back Old Predictions
+def test_archive_old_predictions(tmp_path, monkeypatch):
+    import db
+    monkeypatch.setattr(db, 'DB_NAME', str(tmp_path / 'predictions.db'))
+    db.init_db()
+    conn = db.get_db_connection()
+
+    # Indexes from the schema migrations are in place
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert 'idx_predictions_timestamp' in indexes
+
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    conn.executemany(
+        'INSERT INTO predictions (id, title, body, predicted_label, confidence, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
+        [
+            ('old-1', 'Old bug', 'Crash', 'bug', 0.9, '2020-01-15 10:00:00'),
+            ('old-2', 'Old question', 'How?', 'question', 0.8, '2020-02-03 10:00:00'),
+            ('new-1', 'New bug', 'Crash', 'bug', 0.7, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ]
+    )
+    conn.commit()
+
+    archive_dir = str(tmp_path / 'archive')
+    assert db.archive_old_predictions(conn, retention_days=30, archive_dir=archive_dir) == 2
+    assert sorted(os.listdir(archive_dir)) == ['predictions-2020-01.ndjson.gz', 'predictions-2020-02.ndjson.gz']
+    # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+    assert conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0] == 1
+    assert db.compact_db(conn) == 0
+
+    # Archived rows can still be read back for retraining and export
+    ids = {record['id'] for record in db.load_all_predictions(conn, archive_dir=archive_dir)}
+    assert ids == {'old-1', 'old-2', 'new-1'}
+    conn.close()
+
+
+# 10. Test Health and Readiness Endpoints
+def test_health_and_readiness(client):
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ok'
+
+    # The real model and NLTK data were warmed up when the app was imported
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'ready'
+
+
+# 11. Test the Input Budget Collapses Stack Traces and Caps Tokens
+def test_input_budget():
+    from preprocessing import collapse_repetitive_lines, select_head_tail, preprocess_text_with_report
+
+    trace = "App crashes on login\njava.lang.NullPointerException\n" + "".join(
+        f"\tat com.example.Login.step{i}(Login.java:{i})\n" for i in range(100)
+    ) + "Please help"
+    collapsed, removed = collapse_repetitive_lines(trace, max_repeated_lines=5)
+    assert removed == 95
+    assert collapsed.startswith("App crashes on login")
+    assert collapsed.endswith("Please help")
+    assert "step99" in collapsed
+
+    # Head and tail are kept in their original order
+    assert select_head_tail(list(range(10)), 4) == [0, 1, 2, 9]
+
+    tokens, report = preprocess_text_with_report("crash " * 5000, max_tokens=100)
+    assert len(tokens) == 100
+    assert report["truncated"]
+    assert report["original_tokens"] == 5000
+
+    _, report = preprocess_text_with_report("The login page crashes")
+    assert not report["truncated"]
+
+    # Whitespace-only head or tail slices are dropped instead of failing
+    from preprocessing import apply_input_budget
+    for text in ("word " * 3000 + " " * 6000, " " * 16000 + "word " * 3000):
+        bounded, report = apply_input_budget(text, max_chars=20000)
+        assert "word" in bounded
+        assert report["dropped_chars"] > 0
+
+
+# 12. Test Metrics Endpoint Reports Accuracy Derived from the Counters
+@patch('app.get_db_connection')
+def test_metrics_accuracy(mock_get_db_connection, client):
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_get_db_connection.return_value = mock_conn
+    mock_conn.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = ("bug",)
+
+    client.post('/api/correct', json={"id": "91e897be-dcee-4da2-b828-0a65122da033", "corrected_label": "bug"})
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    lines = response.data.decode().splitlines()
+    accuracy = [line for line in lines if line.startswith('model_accuracy ')]
+    assert len(accuracy) == 1
+    assert 0.0 < float(accuracy[0].split()[1]) <= 1.0
+
+
+# 13. Test the Streaming Model Trains in Chunks and Serves Like the Batch Pipeline
+def test_streaming_model():
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from model import create_streaming_model, partial_fit_model
+
+    texts = [
+        "app crashes on login", "error when saving file", "add dark mode",
+        "support csv export", "how do i use the api", "what does this setting do"
+    ]
+    labels = ["bug", "bug", "enhancement", "enhancement", "question", "question"]
+
+    model = create_streaming_model()
+    for start in range(0, len(texts), 2):
+        partial_fit_model(model, texts[start:start + 2], labels[start:start + 2])
+
+    # Same interface the serving code relies on
+    assert model.named_steps['classifier'].classes_.tolist() == ["bug", "enhancement", "question"]
+    probabilities = model.predict_proba(["app crashes when saving"])
+    assert probabilities.shape == (1, 3)
+    assert model.predict(["app crashes when saving"])[0] in labels
+
+    # The incrementally maintained IDF matches a TfidfVectorizer fitted on everything at once
+    streamed = model.named_steps['tfidf'].transform([texts[0]])
+    batch = TfidfVectorizer().fit(texts).transform([texts[0]])
+    assert np.allclose(sorted(streamed.data), sorted(batch.data))
+
+
+# 14. Test a Corrupt or Outdated Similarity Index File Is Rebuilt Instead of Reused
+def test_load_index_rebuilds_corrupt_file(tmp_path):
+    from similarity import SimilarityIndex, load_index
+
+    index_filename = str(tmp_path / 'predictions_index.pkl')
+    with open(index_filename, 'wb') as f:
+        f.write(b'not a pickle')
+
+    index = load_index(10, index_filename)
+    assert isinstance(index, SimilarityIndex)
+    assert len(index) == 0
+
+    # An index saved for a refitted vectorizer with the same number of features is rebuilt too
+    import scipy.sparse as sp
+    index = SimilarityIndex(2, fingerprint='old-idf')
+    index.add('issue-1', sp.csr_matrix([[1.0, 0.0]]))
+    index.save(index_filename)
+    assert len(load_index(2, index_filename, fingerprint='old-idf')) == 1
+    assert len(load_index(2, index_filename, fingerprint='new-idf')) == 0
+
+
+# 15. Test Metrics from Several Worker Processes Are Aggregated and Kept After a Worker Exits
+def test_multiprocess_metrics(tmp_path):
+    import subprocess
+    import sys
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+
+    def run(code):
+        return subprocess.run([sys.executable, '-c', code], cwd=scripts_dir, env=env,
+                              capture_output=True, text=True, check=True).stdout
+
+    # Two "workers" record corrections in their own files
+    worker = ("import os; from metrics import correct_predictions, incorrect_predictions; "
+              "correct_predictions.labels(category='bug').inc({}); "
+              "incorrect_predictions.labels(category='bug').inc({}); print(os.getpid())")
+    pids = [int(run(worker.format(3, 1))), int(run(worker.format(1, 3)))]
+
+    scrape = ("from metrics import generate_metrics; "
+              "print(generate_metrics().decode())")
+
+    def totals():
+        lines = run(scrape).splitlines()
+        values = {}
+        for prefix in ('correct_predictions_total{', 'incorrect_predictions_total{', 'model_accuracy '):
+            matching = [line for line in lines if line.startswith(prefix)]
+            assert len(matching) == 1
+            values[prefix] = float(matching[0].split()[-1])
+        return values
+
+    expected = {'correct_predictions_total{': 4.0, 'incorrect_predictions_total{': 4.0, 'model_accuracy ': 0.5}
+    assert totals() == expected
+
+    # Merging the exited workers' files keeps the totals and removes the per-worker files
+    from metrics import merge_worker_files
+    for pid in pids:
+        assert merge_worker_files(pid, str(tmp_path)) == 2  # Counters and the confidence summary
+    filenames = os.listdir(tmp_path)
+    assert 'counter_archive.db' in filenames
+    assert not [name for name in filenames if name.endswith((f'_{pids[0]}.db', f'_{pids[1]}.db'))]
+    assert totals() == expected
+
+
+# 16. Test the Similarity Index Picks Up New Rows After the Newest Rows Were Archived
+def test_sync_index_after_archiving(tmp_path, monkeypatch):
+    import scipy.sparse as sp
+    import db
+    from similarity import SimilarityIndex, sync_index
+    monkeypatch.setattr(db, 'DB_NAME', str(tmp_path / 'predictions.db'))
+    db.init_db()
+    conn = db.get_db_connection()
+
+    def vectorize(text):
+        return sp.csr_matrix([[1.0, 0.0]] if text == 'crash' else [[0.0, 1.0]])
+
+    def insert(issue_id, text, timestamp):
+        # noinspection SqlDialectInspection,SqlNoDataSourceInspection
+        conn.execute('INSERT INTO predictions (id, preprocessed_text, timestamp) VALUES (?, ?, ?)',
+                     (issue_id, text, timestamp))
+        conn.commit()
+
+    index = SimilarityIndex(2)
+    insert('old-1', 'crash', '2020-01-15 10:00:00')
+    insert('old-2', 'dark mode', '2020-01-16 10:00:00')
+    assert sync_index(index, conn, vectorize) == 2
+
+    # Archiving every row frees their rowids, so the next insert reuses rowid 1
+    assert db.archive_old_predictions(conn, retention_days=30, archive_dir=str(tmp_path / 'archive')) == 2
+    insert('new-1', 'crash', datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    assert sync_index(index, conn, vectorize) == 1
+    assert 'new-1' in index
+    conn.close()
@@ -1,62 +1,161 @@
+import argparse
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, classification_report
-from model import create_model, train_model, save_model, predict_category, extract_important_features
+from model import (create_model, train_model, save_model, load_model, predict_category, extract_important_features,
+                   create_streaming_model, partial_fit_model, ISSUE_LABELS)
 
-# Load preprocessed data
-df = pd.read_excel(r'C:\ws2024-principles-of-ai-engineering\preprocessed.xlsx')
+PREPROCESSED_XLSX = r'C:\ws2024-principles-of-ai-engineering\preprocessed.xlsx'
+PREPROCESSED_CSV = r'C:\ws2024-principles-of-ai-engineering\preprocessed.csv'
+MODEL_PATH = r'C:\ws2024-principles-of-ai-engineering\random_forest_model.pkl'
+STREAMING_MODEL_PATH = r'C:\ws2024-principles-of-ai-engineering\streaming_model.pkl'
 
-# Ensure clean_text and issue_label columns are present
-if 'text' not in df.columns or 'issue_label' not in df.columns:
-    raise ValueError("The preprocessed data must have 'clean_text' and 'issue_label' columns.")
 
-# Feature and target
-X = df['text']
-y = df['issue_label']
+def evaluate(model, X_test, y_test):
+    """Print accuracy and the classification report on held-out data."""
+    y_pred = model.predict(X_test)
 
-# Split data into train and test sets
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    print(f"Accuracy: {accuracy_score(y_test, y_pred):.4f}")
+    print("Classification Report:")
+    print(classification_report(y_test, y_pred))
 
-# Create the model
-model = create_model()
 
-# Train the model
-train_model(model, X_train, y_train)
-print("Model trained successfully!")
+def predict_examples(model):
+    """Predict categories for new inputs."""
+    random_inputs = [
+        "The application crashes when I click the submit button on the form",
+        "It would be great if we could add a dark mode option to the settings",
+        "Can someone explain how to use the API with Python?"
+    ]
 
-# Save the trained model
-model_path = r'C:\ws2024-principles-of-ai-engineering\random_forest_model.pkl'
-save_model(model, model_path)
-print(f"Model saved to {model_path}")
+    predicted_categories = predict_category(random_inputs, model)
 
-# Evaluate the model
-y_pred = model.predict(X_test)
+    for text, prediction in zip(random_inputs, predicted_categories):
+        print(f"Input: {text}\nPredicted Category: {prediction}\n")
 
-print(f"Accuracy: {accuracy_score(y_test, y_pred):.4f}")
-print("Classification Report:")
-print(classification_report(y_test, y_pred))
 
-# Extract feature importances
-tfidf_step = model.named_steps['tfidf']  # Access the TF-IDF step in the pipeline
-classifier_step = model.named_steps['classifier']  # Access the classifier step in the pipeline
+def train_batch(data_path=PREPROCESSED_XLSX, model_path=MODEL_PATH):
+    """Train the TF-IDF + random forest pipeline on the whole preprocessed dataset at once."""
+    # Load preprocessed data
+    df = pd.read_excel(data_path)
 
-if hasattr(classifier_step, "feature_importances_"):
-    importances = classifier_step.feature_importances_
-    top_features = extract_important_features(tfidf_step, importances, n=10)
-    print("Top 10 important features:")
-    for feature in top_features:
-        print(f"{feature['feature_name']}: {feature['importance_score']}")
-else:
-    print("The classifier does not provide feature importances.")
+    # Ensure clean_text and issue_label columns are present
+    if 'text' not in df.columns or 'issue_label' not in df.columns:
+        raise ValueError("The preprocessed data must have 'clean_text' and 'issue_label' columns.")
 
-# Predict categories for new inputs
-random_inputs = [
-    "The application crashes when I click the submit button on the form",
-    "It would be great if we could add a dark mode option to the settings",
-    "Can someone explain how to use the API with Python?"
-]
+    # Feature and target
+    X = df['text']
+    y = df['issue_label']
 
-predicted_categories = predict_category(random_inputs, model)
+    # Split data into train and test sets
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-for text, prediction in zip(random_inputs, predicted_categories):
-    print(f"Input: {text}\nPredicted Category: {prediction}\n")
+    # Create the model
+    model = create_model()
+
+    # Train the model
+    train_model(model, X_train, y_train)
+    print("Model trained successfully!")
+
+    # Save the trained model
+    save_model(model, model_path)
+    print(f"Model saved to {model_path}")
+
+    # Evaluate the model
+    evaluate(model, X_test, y_test)
+
+    # Extract feature importances
+    tfidf_step = model.named_steps['tfidf']  # Access the TF-IDF step in the pipeline
+    classifier_step = model.named_steps['classifier']  # Access the classifier step in the pipeline
+
+    if hasattr(classifier_step, "feature_importances_"):
+        importances = classifier_step.feature_importances_
+        top_features = extract_important_features(tfidf_step, importances, n=10)
+        print("Top 10 important features:")
+        for feature in top_features:
+            print(f"{feature['feature_name']}: {feature['importance_score']}")
+    else:
+        print("The classifier does not provide feature importances.")
+
+    predict_examples(model)
+    return model
+
+
+def train_streaming(data_path=PREPROCESSED_CSV, model_path=STREAMING_MODEL_PATH, chunk_size=10000,
+                    epochs=1, resume=False, max_test_rows=10000):
+    """
+    Train the hashing TF-IDF + SGD pipeline chunk by chunk, so the corpus never has to fit in memory.
+
+    :param data_path: Preprocessed CSV with 'text' and 'issue_label' columns
+                      (load_and_preprocess_multiple writes CSV when its output path ends with .csv).
+    :param model_path: Where the streaming model is saved (and loaded from when resuming).
+    :param chunk_size: Rows read per chunk.
+    :param epochs: Passes over the data.
+    :param resume: Continue training a saved model, e.g. to fold in new corrections without a full refit.
+    :param max_test_rows: Maximum held-out rows kept in memory for evaluation.
+    """
+    model = load_model(model_path) if resume else create_streaming_model()
+
+    X_test, y_test = [], []
+    trained_rows = 0
+    skipped_rows = 0
+    for epoch in range(epochs):
+        rows_read = 0
+        for chunk in pd.read_csv(data_path, usecols=['text', 'issue_label'], chunksize=chunk_size):
+            chunk = chunk.dropna()
+            known = chunk['issue_label'].isin(ISSUE_LABELS)
+            skipped_rows += int((~known).sum()) if epoch == 0 else 0
+            chunk = chunk[known]
+
+            # Hold out every fifth row for evaluation
+            held_out = (chunk.index % 5 == 0)
+            if epoch == 0 and len(X_test) < max_test_rows:
+                X_test.extend(chunk['text'][held_out].tolist()[:max_test_rows - len(X_test)])
+                y_test.extend(chunk['issue_label'][held_out].tolist()[:max_test_rows - len(y_test)])
+
+            train_chunk = chunk[~held_out]
+            if len(train_chunk):
+                partial_fit_model(model, train_chunk['text'].tolist(), train_chunk['issue_label'].tolist(),
+                                  update_idf=(epoch == 0))
+                trained_rows += len(train_chunk)
+            rows_read += len(chunk)
+        print(f"Epoch {epoch + 1}/{epochs} done, {rows_read} rows read.")
+
+    if skipped_rows:
+        print(f"Skipped {skipped_rows} rows with labels outside {ISSUE_LABELS}.")
+    print(f"Model trained on {trained_rows} rows.")
+
+    # Save the trained model
+    save_model(model, model_path)
+    print(f"Model saved to {model_path}")
+
+    if X_test:
+        evaluate(model, X_test, y_test)
+
+    predict_examples(model)
+    return model
+
+
+# Entry point for standalone usage
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the issue classification model.")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Train the out-of-core hashing TF-IDF + SGD model from a preprocessed CSV.")
+    parser.add_argument('--data', help="Preprocessed data file.")
+    parser.add_argument('--model', help="Where to save the model.")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Rows per chunk (streaming only).")
+    parser.add_argument('--epochs', type=int, default=1, help="Passes over the data (streaming only).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue training an existing streaming model with new data.")
+    args = parser.parse_args()
+
+    if args.streaming:
+        train_streaming(
+            data_path=args.data or PREPROCESSED_CSV,
+            model_path=args.model or STREAMING_MODEL_PATH,
+            chunk_size=args.chunk_size,
+            epochs=args.epochs,
+            resume=args.resume
+        )
+    else:
+        train_batch(data_path=args.data or PREPROCESSED_XLSX, model_path=args.model or MODEL_PATH)